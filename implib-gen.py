@@ -17,12 +17,39 @@ import os.path
 import re
 import subprocess
 import argparse
+import bisect
+import contextlib
 import string
+import struct
+import threading
 import configparser
 
 me = os.path.basename(__file__)
 root = os.path.dirname(__file__)
 
+# Patterns used in parsing loops, compiled once
+_RE_LOCALENTRY = re.compile(r"\[<localentry>: [0-9]+\]")
+_RE_NR_BRACKET = re.compile(r"\[\s+")
+_RE_ADDEND = re.compile(r" \+ ")
+_RE_DEF_SYM = re.compile(r"^\s+([A-Za-z0-9_]+)\s*$")
+_RE_DEF_COMMENT = re.compile(r"^\s*;")
+_RE_LIBNAME = re.compile(r"^(?:LIBRARY|NAME)\s+([A-Za-z0-9_.\-]+)$")
+_RE_WS2 = re.compile(r"\s\s+")
+_RE_COMMENT = re.compile(r"#.*")
+_RE_VTABLE = re.compile(r"^(vtable|typeinfo|typeinfo name) for (.*)")
+
+# Prefixes of target triples and corresponding arch/ subdirs
+# (checked in order so longer prefixes go first)
+_TARGET_PREFIXES = (
+    ("arm", "arm"),  # Handle armhf-..., armel-...
+    ("amd64", "x86_64"),
+    ("mips64", "mips64"),  # Handle mips64-..., mips64el-..., mips64le-...
+    ("mips", "mips"),  # Handle mips-..., mipsel-..., mipsle-...
+    ("ppc64le", "powerpc64le"),
+    ("ppc64", "powerpc64"),
+    ("rv64", "riscv64"),
+)
+
 
 def warn(msg):
     """Emits a nicely-decorated warning."""
@@ -35,8 +62,8 @@ def error(msg):
     sys.exit(1)
 
 
-def run(args, stdin=""):
-    """Runs external program and aborts on error."""
+def make_env():
+    """Makes environment for external programs."""
     env = os.environ.copy()
     # Force English language
     env["LC_ALL"] = "c"
@@ -44,12 +71,17 @@ def run(args, stdin=""):
         del env["LANG"]
     except KeyError:
         pass
+    return env
+
+
+def run(args, stdin=""):
+    """Runs external program and aborts on error."""
     with subprocess.Popen(
         args,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        env=env,
+        env=make_env(),
     ) as p:
         out, err = p.communicate(input=stdin.encode("utf-8"))
     out = out.decode("utf-8")
@@ -59,19 +91,60 @@ def run(args, stdin=""):
     return out, err
 
 
-def is_binary_file(filename):
-    """Check if file is an ELF or Mach-O binary."""
-    # First try readelf for ELF files
+@contextlib.contextmanager
+def run_lines(args):
+    """Runs external program and provides iterator over lines of its output
+    as they arrive.
+
+    Aborts on error like run(). Callers must read the whole output:
+    leaving the context early terminates the program (via closed pipe)
+    which is then reported as an error."""
+    with subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=make_env(),
+        encoding="utf-8",
+    ) as p:
+        # Drain stderr in background so that program does not block on it
+        errs = []
+        drainer = threading.Thread(target=lambda: errs.append(p.stderr.read()))
+        drainer.start()
+        try:
+            yield p.stdout
+        finally:
+            p.stdout.close()
+            p.wait()
+            drainer.join()
+    err = "".join(errs)
+    if p.returncode != 0 or err:
+        error(f"{args[0]} failed with retcode {p.returncode}:\n{err}")
+
+
+def read_dynamic_section(filename):
+    """Read ELF's dynamic section (returns None if file is not an ELF)."""
     cmd = ["readelf", "-d", filename]
     with subprocess.Popen(
         cmd,
         stdin=subprocess.DEVNULL,
-        stdout=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
         stderr=subprocess.DEVNULL,
+        env=make_env(),
     ) as p:
-        p.communicate()
-    if p.returncode == 0:
-        return True
+        out, _ = p.communicate()
+    if p.returncode != 0:
+        return None
+    return out.decode("utf-8", errors="ignore")
+
+
+def classify_binary_file(filename, dynamic):
+    """Check if file is an ELF or Mach-O binary.
+
+    Returns a pair (is_binary, is_macho)."""
+    # ELF files are recognized by readelf
+    if dynamic is not None:
+        return True, False
 
     # If readelf fails, try file command for Mach-O files (macOS)
     try:
@@ -85,142 +158,156 @@ def is_binary_file(filename):
             out, _ = p.communicate()
             output = out.decode("utf-8", errors="ignore")
             # Check for Mach-O binary signatures
-            return any(sig in output for sig in ["Mach-O", "shared library"])
+            is_binary = any(sig in output for sig in ["Mach-O", "shared library"])
+            return is_binary, "Mach-O" in output
     except (OSError, UnicodeDecodeError):
         pass
 
-    return False
+    return False, False
+
+
+def normalize_target(triple):
+    """Convert target triple to name of architecture."""
+    # Handle i386-..., i686-..., etc.
+    if triple[:1] == "i" and triple[1:2].isdigit() and triple[2:4] == "86":
+        return "i386"
+    for prefix, target in _TARGET_PREFIXES:
+        if triple.startswith(prefix):
+            return target
+    return triple.split("-")[0]
 
 
 def make_toc(words, renames=None):
-    "Make an mapping of words to their indices in list"
+    "Make a list of column names"
     renames = renames or {}
-    toc = {}
-    for i, n in enumerate(words):
-        name = renames.get(n, n)
-        toc[i] = name
-    return toc
+    # Names are interned as they become keys of every row
+    return [sys.intern(renames.get(n, n)) for n in words]
+
+
+def hex_indices(toc, hex_keys):
+    "Make a set of indices of columns with hex values"
+    return frozenset(i for i, k in enumerate(toc) if k in hex_keys)
 
 
-def parse_row(words, toc, hex_keys):
+def parse_row(words, toc, hex_idx):
     "Make a mapping from column names to values"
-    vals = {k: (words[i] if i < len(words) else "") for i, k in toc.items()}
-    for k in hex_keys:
-        if vals[k]:
-            vals[k] = int(vals[k], 16)
+    vals = {}
+    nwords = len(words)
+    for i, k in enumerate(toc):
+        w = words[i] if i < nwords else ""
+        vals[k] = int(w, 16) if w and i in hex_idx else w
     return vals
 
 
-def collect_syms(f):
-    """Collect ELF dynamic symtab and determine visibility using nm."""
+def collect_syms(f, is_macho):
+    """Collect ELF dynamic symtab (or Mach-O symbols via nm)."""
 
-    # Use nm to determine visibility
-    nm_out, _ = run(["nm", "-g", f])
-
-    # Parse nm output to get visibility
-    visibility = {}
-    for line in nm_out.splitlines():
-        parts = line.split()
-        if len(parts) >= 3:
-            symbol_type = parts[1]
-            symbol_name = parts[2]
-            # Global symbols have uppercase types, local/weak have lowercase
-            visibility[symbol_name] = "DEFAULT" if symbol_type.isupper() else "HIDDEN"
+    if is_macho:
+        # Use nm to determine visibility
+        nm_out, _ = run(["nm", "-g", f])
 
-    # Check if this is a Mach-O file (macOS)
-    try:
-        # Try to detect Mach-O files
-        file_out, _ = run(["file", f])
-        is_macho = "Mach-O" in file_out
-    except (OSError, subprocess.SubprocessError):
-        is_macho = False
+        # Parse nm output to get visibility
+        visibility = {}
+        for line in nm_out.splitlines():
+            parts = line.split()
+            if len(parts) >= 3:
+                symbol_type = parts[1]
+                symbol_name = parts[2]
+                # Global symbols have uppercase types, local/weak have lowercase
+                visibility[symbol_name] = (
+                    "DEFAULT" if symbol_type.isupper() else "HIDDEN"
+                )
 
-    if is_macho:
         # Use nm for Mach-O files to extract symbols
-        nm_detailed_out, _ = run(["nm", "-D", f])
-        readelf_out = nm_detailed_out
+        cmd = ["nm", "-D", f]
     else:
-        # Use readelf for ELF files
-        readelf_out, _ = run(["readelf", "-sW", f])
+        # Use readelf for ELF files (it also reports visibility)
+        cmd = ["readelf", "-sW", f]
 
     syms = []
     syms_set = set()
 
-    if is_macho:
-        # Parse nm output for Mach-O files (simplified)
-        for line in readelf_out.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-
-            parts = line.split()
-            if len(parts) >= 3:
-                address = parts[0]
-                symbol_type = parts[1]
-                name = parts[2]
-
-                if name in syms_set:
+    with run_lines(cmd) as lines:
+        if is_macho:
+            # Parse nm output for Mach-O files (simplified)
+            for line in lines:
+                line = line.strip()
+                if not line:
                     continue
-                syms_set.add(name)
-
-                # Create minimal symbol info for Mach-O
-                sym = {
-                    "Name": name,
-                    "Value": int(address, 16) if address != "U" else 0,
-                    "Size": 0,  # nm doesn't provide size info
-                    "Type": "FUNC" if symbol_type.upper() == "T" else "OBJECT",
-                    "Bind": "GLOBAL" if symbol_type.isupper() else "LOCAL",
-                    "Ndx": "1" if symbol_type.upper() != "U" else "UND",
-                    "Default": True,
-                    "Version": None,
-                    "Visibility": visibility.get(name, "DEFAULT"),
-                }
-                syms.append(sym)
-    else:
-        # Parse readelf output for ELF files
-        toc = None
 
-        for line in readelf_out.splitlines():
-            line = line.strip()
-
-            # Strip out strange markers in powerpc64le ELFs
-            line = re.sub(r"\[<localentry>: [0-9]+\]", "", line)
+                parts = line.split()
+                if len(parts) >= 3:
+                    address = parts[0]
+                    symbol_type = parts[1]
+                    name = parts[2]
+
+                    if name in syms_set:
+                        continue
+                    syms_set.add(name)
+
+                    # Create minimal symbol info for Mach-O
+                    sym = {
+                        "Name": name,
+                        "Value": int(address, 16) if address != "U" else 0,
+                        "Size": 0,  # nm doesn't provide size info
+                        "Type": "FUNC" if symbol_type.upper() == "T" else "OBJECT",
+                        "Bind": "GLOBAL" if symbol_type.isupper() else "LOCAL",
+                        "Ndx": "1" if symbol_type.upper() != "U" else "UND",
+                        "Default": True,
+                        "Version": None,
+                        "Visibility": visibility.get(name, "DEFAULT"),
+                    }
+                    syms.append(sym)
+        else:
+            # Parse readelf output for ELF files
+            toc = None
+            # Columns with small set of values which are worth interning
+            enum_cols = []
 
-            if not line:
-                # Next symtab
-                toc = None
-                continue
+            for line in lines:
+                line = line.strip()
 
-            words = re.split(r" +", line)
+                # Strip out strange markers in powerpc64le ELFs
+                if "[<" in line:
+                    line = _RE_LOCALENTRY.sub("", line)
 
-            if line.startswith("Num"):  # Header?
-                if toc is not None:
-                    error("multiple headers in output of readelf")
-                # Colons are different across readelf versions so get rid of them.
-                toc = make_toc(map(lambda n: n.replace(":", ""), words))
-            elif toc is not None:
-                sym = parse_row(words, toc, ["Value"])
-                name = sym["Name"]
-                if not name:
+                if not line:
+                    # Next symtab
+                    toc = None
                     continue
-                if name in syms_set:
-                    continue
-                syms_set.add(name)
-                sym["Size"] = int(
-                    sym["Size"], 0
-                )  # Readelf is inconsistent on Size format
-                if "@" in name:
-                    sym["Default"] = "@@" in name
-                    name, ver = re.split(r"@+", name)
-                    sym["Name"] = name
-                    sym["Version"] = ver
-                else:
-                    sym["Default"] = True
-                    sym["Version"] = None
-
-                # Add visibility information
-                sym["Visibility"] = visibility.get(name, "DEFAULT")
-                syms.append(sym)
+
+                if line.startswith("Num"):  # Header?
+                    if toc is not None:
+                        error("multiple headers in output of readelf")
+                    # Colons are different across readelf versions so get rid of them.
+                    toc = make_toc(map(lambda n: n.replace(":", ""), line.split()))
+                    enum_cols = [k for k in ("Type", "Bind", "Vis", "Ndx") if k in toc]
+                    hex_idx = hex_indices(toc, ["Value"])
+                elif toc is not None:
+                    sym = parse_row(line.split(), toc, hex_idx)
+                    name = sym["Name"]
+                    if not name:
+                        continue
+                    if name in syms_set:
+                        continue
+                    syms_set.add(name)
+                    for k in enum_cols:
+                        sym[k] = sys.intern(sym[k])
+                    sym["Size"] = int(
+                        sym["Size"], 0
+                    )  # Readelf is inconsistent on Size format
+                    if "@" in name:
+                        sym["Default"] = "@@" in name
+                        name, _, ver = name.partition("@")
+                        ver = ver.lstrip("@")
+                        sym["Name"] = name
+                        sym["Version"] = ver
+                    else:
+                        sym["Default"] = True
+                        sym["Version"] = None
+
+                    sym["Visibility"] = sym["Vis"]
+                    syms.append(sym)
 
     if not is_macho and toc is None:
         error(f"failed to analyze symbols in {f}")
@@ -232,44 +319,39 @@ def collect_def_exports(filename):
     """Reads exported symbols from .def file."""
 
     syms = []
+    in_exports = False
 
     try:
         with open(filename, "r", encoding="utf-8") as f:
-            lines = f.readlines()
+            for line in f:
+                if in_exports:
+                    if _RE_DEF_COMMENT.match(line):  # Comment
+                        continue
+
+                    # TODO: support renames
+                    m = _RE_DEF_SYM.match(line)
+                    if m is not None:
+                        sym = {
+                            "Name": m[1],
+                            "Bind": "GLOBAL",
+                            "Type": "FUNC",
+                            "Ndx": "0",
+                            "Default": True,
+                            "Version": None,
+                            "Size": 0,
+                            "Visibility": "DEFAULT",
+                        }
+                        syms.append(sym)
+                        continue
+
+                    # End of EXPORTS, line may start a new one
+                    in_exports = False
+
+                if line.strip() == "EXPORTS":
+                    in_exports = True
     except (UnicodeDecodeError, IOError):
         # Not a text file, return empty list
-        return syms
-    lines.reverse()
-
-    while lines:
-        line = lines.pop().strip()
-
-        if line != "EXPORTS":
-            continue
-
-        while lines:
-            line = lines.pop()
-
-            if re.match(r"^\s*;", line):  # Comment
-                continue
-
-            # TODO: support renames
-            m = re.match(r"^\s+([A-Za-z0-9_]+)\s*$", line)
-            if m is None:
-                lines.append(line)
-                break
-
-            sym = {
-                "Name": m[1],
-                "Bind": "GLOBAL",
-                "Type": "FUNC",
-                "Ndx": "0",
-                "Default": True,
-                "Version": None,
-                "Size": 0,
-                "Visibility": "DEFAULT",
-            }
-            syms.append(sym)
+        return []
 
     if not syms:
         warn(f"failed to locate symbols in {filename}")
@@ -277,64 +359,66 @@ def collect_def_exports(filename):
     return syms
 
 
-def collect_relocs(f):
+def collect_relocs(f, is_macho):
     """Collect ELF dynamic relocs."""
 
-    # Check if this is a Mach-O file (macOS)
-    try:
-        file_out, _ = run(["file", f])
-        if "Mach-O" in file_out:
-            # Return empty list for Mach-O files - relocations not supported yet
-            return []
-    except (OSError, subprocess.SubprocessError):
-        pass
-
-    out, _ = run(["readelf", "-rW", f])
+    if is_macho:
+        # Return empty list for Mach-O files - relocations not supported yet
+        return []
 
     toc = None
     rels = []
-    for line in out.splitlines():
-        line = line.strip()
-        if not line:
-            toc = None
-            continue
-        if line == "There are no relocations in this file.":
-            return []
-        if re.match(r"^\s*Type[0-9]:", line):  # Spurious lines for MIPS
-            continue
-        if re.match(r"^\s*Offset", line):  # Header?
-            if toc is not None:
-                error("multiple headers in output of readelf")
-            words = re.split(r"\s\s+", line)  # "Symbol's Name + Addend"
-            toc = make_toc(words)
-        elif re.match(r"^\s*r_offset", line):  # FreeBSD header?
-            if toc is not None:
-                error("multiple headers in output of readelf")
-            words = re.split(r"\s\s+", line)  # "st_name + r_addend"
-            toc = make_toc(words)
-            rename = {
-                "r_offset": "Offset",
-                "r_info": "Info",
-                "r_type": "Type",
-                "st_value": "Symbol's Value",
-                "st_name + r_addend": "Symbol's Name + Addend",
-            }
-            toc = {idx: rename[name] for idx, name in toc.items()}
-        elif toc is not None:
-            line = re.sub(r" \+ ", "+", line)
-            words = re.split(r"\s+", line)
-            rel = parse_row(words, toc, ["Offset", "Info"])
-            rels.append(rel)
-            # Split symbolic representation
-            sym_name = "Symbol's Name + Addend"
-            if sym_name not in rel and "Symbol's Name" in rel:
-                # Adapt to different versions of readelf
-                rel[sym_name] = rel["Symbol's Name"] + "+0"
-            if rel[sym_name]:
-                p = rel[sym_name].split("+")
-                if len(p) == 1:
-                    p = ["", p[0]]
-                rel[sym_name] = (p[0], int(p[1], 16))
+    no_relocs = False
+    with run_lines(["readelf", "-rW", f]) as lines:
+        for line in lines:
+            line = line.strip()
+            if not line:
+                toc = None
+                continue
+            if line == "There are no relocations in this file.":
+                # Keep reading so that readelf's status is checked
+                no_relocs = True
+                continue
+            if line[:4] == "Type" and line[4:5].isdigit() and line[5:6] == ":":
+                continue  # Spurious lines for MIPS
+            if line.startswith("Offset"):  # Header?
+                if toc is not None:
+                    error("multiple headers in output of readelf")
+                words = _RE_WS2.split(line)  # "Symbol's Name + Addend"
+                toc = make_toc(words)
+                hex_idx = hex_indices(toc, ["Offset", "Info"])
+            elif line.startswith("r_offset"):  # FreeBSD header?
+                if toc is not None:
+                    error("multiple headers in output of readelf")
+                words = _RE_WS2.split(line)  # "st_name + r_addend"
+                toc = make_toc(words)
+                rename = {
+                    "r_offset": "Offset",
+                    "r_info": "Info",
+                    "r_type": "Type",
+                    "st_value": "Symbol's Value",
+                    "st_name + r_addend": "Symbol's Name + Addend",
+                }
+                toc = [rename[name] for name in toc]
+                hex_idx = hex_indices(toc, ["Offset", "Info"])
+            elif toc is not None:
+                line = _RE_ADDEND.sub("+", line)
+                words = line.split()
+                rel = parse_row(words, toc, hex_idx)
+                rels.append(rel)
+                # Split symbolic representation
+                sym_name = "Symbol's Name + Addend"
+                if sym_name not in rel and "Symbol's Name" in rel:
+                    # Adapt to different versions of readelf
+                    rel[sym_name] = rel["Symbol's Name"] + "+0"
+                if rel[sym_name]:
+                    p = rel[sym_name].split("+")
+                    if len(p) == 1:
+                        p = ["", p[0]]
+                    rel[sym_name] = (p[0], int(p[1], 16))
+
+    if no_relocs:
+        return []
 
     if toc is None:
         error(f"failed to analyze relocations in {f}")
@@ -342,36 +426,31 @@ def collect_relocs(f):
     return rels
 
 
-def collect_sections(f):
+def collect_sections(f, is_macho):
     """Collect section info from ELF."""
 
-    # Check if this is a Mach-O file (macOS)
-    try:
-        file_out, _ = run(["file", f])
-        if "Mach-O" in file_out:
-            # Return empty list for Mach-O files - sections not supported yet
-            return []
-    except (OSError, subprocess.SubprocessError):
-        pass
-
-    out, _ = run(["readelf", "-SW", f])
+    if is_macho:
+        # Return empty list for Mach-O files - sections not supported yet
+        return []
 
     toc = None
     sections = []
-    for line in out.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        line = re.sub(r"\[\s+", "[", line)
-        words = re.split(r" +", line)
-        if line.startswith("[Nr]"):  # Header?
-            if toc is not None:
-                error("multiple headers in output of readelf")
-            toc = make_toc(words, {"Addr": "Address"})
-        elif line.startswith("[") and toc is not None:
-            sec = parse_row(words, toc, ["Address", "Off", "Size"])
-            if "A" in sec["Flg"]:  # Allocatable section?
-                sections.append(sec)
+    with run_lines(["readelf", "-SW", f]) as lines:
+        for line in lines:
+            line = line.strip()
+            if not line.startswith("["):
+                continue
+            line = _RE_NR_BRACKET.sub("[", line)
+            words = line.split()
+            if line.startswith("[Nr]"):  # Header?
+                if toc is not None:
+                    error("multiple headers in output of readelf")
+                toc = make_toc(words, {"Addr": "Address"})
+                hex_idx = hex_indices(toc, ["Address", "Off", "Size"])
+            elif toc is not None:
+                sec = parse_row(words, toc, hex_idx)
+                if "A" in sec["Flg"]:  # Allocatable section?
+                    sections.append(sec)
 
     if toc is None:
         error(f"failed to analyze sections in {f}")
@@ -382,6 +461,8 @@ def collect_sections(f):
 def read_unrelocated_data(input_name, syms, secs):
     """Collect unrelocated data from ELF."""
     data = {}
+    secs = sorted(secs, key=lambda sec: sec["Address"])
+    sec_starts = [sec["Address"] for sec in secs]
     with open(input_name, "rb") as f:
 
         def is_symbol_in_section(sym, sec):
@@ -391,15 +472,15 @@ def read_unrelocated_data(input_name, syms, secs):
             return is_start_in_section and is_end_in_section
 
         for name, s in sorted(syms.items(), key=lambda s: s[1]["Value"]):
-            # TODO: binary search (bisect)
-            sec = [sec for sec in secs if is_symbol_in_section(s, sec)]
-            if len(sec) != 1:
+            # Last section which starts at or before symbol
+            i = bisect.bisect_right(sec_starts, s["Value"]) - 1
+            if i < 0 or not is_symbol_in_section(s, secs[i]):
                 error(
                     f"failed to locate section for interval "
                     f"[{s['Value']:x}, {s['Value'] + s['Size']:x})"
                 )
-            sec = sec[0]
-            f.seek(sec["Off"])
+            sec = secs[i]
+            f.seek(sec["Off"] + s["Value"] - sec["Address"])
             data[name] = f.read(s["Size"])
     return data
 
@@ -407,23 +488,25 @@ def read_unrelocated_data(input_name, syms, secs):
 def collect_relocated_data(syms, bites, rels, ptr_size, reloc_types):
     """Identify relocations for each symbol"""
     data = {}
-    for name, s in sorted(syms.items()):
+    rels = sorted(rels, key=lambda rel: rel["Offset"])
+    rel_offsets = [rel["Offset"] for rel in rels]
+    fmt = "<Q" if ptr_size == 8 else "<I"
+    # Order does not matter here, results are sorted by consumers
+    for name, s in syms.items():
         b = bites.get(name)
         assert b is not None
         if s["Demangled Name"].startswith("typeinfo name"):
             data[name] = [("byte", int(x)) for x in b]
             continue
-        data[name] = []
-        for i in range(0, len(b), ptr_size):
-            val = int.from_bytes(
-                b[i * ptr_size : (i + 1) * ptr_size], byteorder="little"
-            )
-            data[name].append(("offset", val))
+        if len(b) % ptr_size != 0:
+            error(f"size of symbol {name} is not a multiple of pointer size")
+        data[name] = [("offset", val) for (val,) in struct.iter_unpack(fmt, b)]
         start = s["Value"]
         finish = start + s["Size"]
-        # TODO: binary search (bisect)
-        for rel in rels:
-            if rel["Type"] in reloc_types and start <= rel["Offset"] < finish:
+        lo = bisect.bisect_left(rel_offsets, start)
+        hi = bisect.bisect_left(rel_offsets, finish)
+        for rel in rels[lo:hi]:
+            if rel["Type"] in reloc_types:
                 i = (rel["Offset"] - start) // ptr_size
                 assert i < len(data[name])
                 data[name][i] = "reloc", rel
@@ -452,8 +535,9 @@ extern "C" {
             if typ != "reloc":
                 continue
             sym_name, addend = val["Symbol's Name + Addend"]
-            sym_name = re.sub(r"@.*", "", sym_name)  # Can we pin version in C?
+            sym_name = sym_name.partition("@")[0]  # Can we pin version in C?
             if sym_name not in cls_syms and sym_name not in printed:
+                printed.add(sym_name)
                 ss.append(
                     f"""\
 extern const char {sym_name}[];
@@ -480,7 +564,7 @@ extern const char {sym_name}[];
                 vals.append(str(val) + "UL")
             else:
                 sym_name, addend = val["Symbol's Name + Addend"]
-                sym_name = re.sub(r"@.*", "", sym_name)  # Can we pin version in C?
+                sym_name = sym_name.partition("@")[0]  # Can we pin version in C?
                 vals.append(f"(const char *)&{sym_name} + {addend}")
         code_info[name] = (
             declarator,
@@ -520,28 +604,24 @@ const {type_name} {name} = {init};
     return "".join(ss)
 
 
-def read_soname(f):
-    """Read ELF's SONAME."""
+def read_soname(f, is_macho, dynamic):
+    """Read ELF's SONAME from output of readelf -d."""
 
-    # Check if this is a Mach-O file (macOS)
-    try:
-        file_out, _ = run(["file", f])
-        if "Mach-O" in file_out:
-            # For Mach-O files, return the filename as soname
-            return os.path.basename(f)
-    except (OSError, subprocess.SubprocessError):
-        pass
+    if is_macho:
+        # For Mach-O files, return the filename as soname
+        return os.path.basename(f)
 
-    out, _ = run(["readelf", "-d", f])
+    if dynamic is None:
+        # Binary was not recognized by readelf, rerun it to report the error
+        dynamic, _ = run(["readelf", "-d", f])
 
-    for line in out.splitlines():
-        line = line.strip()
-        if not line:
-            continue
+    for line in dynamic.splitlines():
         # 0x000000000000000e (SONAME)             Library soname: [libndp.so.0]
-        soname_match = re.search(r"\(SONAME\).*\[(.+)\]", line)
-        if soname_match is not None:
-            return soname_match[1]
+        if "(SONAME)" in line:
+            start = line.find("[")
+            end = line.rfind("]")
+            if start + 1 < end:
+                return line[start + 1 : end]
 
     return None
 
@@ -553,7 +633,7 @@ def read_library_name(filename):
         with open(filename, "r", encoding="utf-8") as f:
             for line in f.readlines():
                 line = line.strip()
-                m = re.match(r"^(?:LIBRARY|NAME)\s+([A-Za-z0-9_.\-]+)$", line)
+                m = _RE_LIBNAME.match(line)
                 if m is not None:
                     return m[1]
     except (UnicodeDecodeError, IOError):
@@ -563,6 +643,37 @@ def read_library_name(filename):
     return None
 
 
+def split_template(tpl, **consts):
+    """Splits template into literal chunks (at even positions)
+    and names of placeholders (at odd positions).
+
+    Placeholders from consts are substituted right away."""
+    # Each match produces 4 groups: escaped, named, braced and invalid
+    parts = tpl.pattern.split(tpl.template)
+    chunks = [parts[0]]
+    for i in range(1, len(parts), 5):
+        escaped, named, braced, _, literal = parts[i : i + 5]
+        name = named or braced
+        if escaped is not None:
+            chunks[-1] += escaped
+        elif name is None:
+            error("invalid placeholder in template")
+        elif name in consts:
+            chunks[-1] += str(consts[name])
+        else:
+            chunks += [name, ""]
+        chunks[-1] += literal
+    return chunks
+
+
+def expand_template(chunks, **vals):
+    """Substitutes placeholders in template split by split_template."""
+    parts = chunks[:]
+    for i in range(1, len(parts), 2):
+        parts[i] = str(vals[parts[i]])
+    return "".join(parts)
+
+
 def main():
     """Driver function"""
     parser = argparse.ArgumentParser(
@@ -696,24 +807,7 @@ Examples:
     dlopen = args.dlopen
     lazy_load = args.lazy_load
     thread_safe = args.thread_safe
-    if args.target.startswith("arm"):
-        target = "arm"  # Handle armhf-..., armel-...
-    elif re.match(r"^i[0-9]86", args.target):
-        target = "i386"
-    elif args.target.startswith("amd64"):
-        target = "x86_64"
-    elif args.target.startswith("mips64"):
-        target = "mips64"  # Handle mips64-..., mips64el-..., mips64le-...
-    elif args.target.startswith("mips"):
-        target = "mips"  # Handle mips-..., mipsel-..., mipsle-...
-    elif args.target.startswith("ppc64le"):
-        target = "powerpc64le"
-    elif args.target.startswith("ppc64"):
-        target = "powerpc64"
-    elif args.target.startswith("rv64"):
-        target = "riscv64"
-    else:
-        target = args.target.split("-")[0]
+    target = normalize_target(args.target)
     quiet = args.quiet
     outdir = args.outdir
     if not os.path.exists(outdir):
@@ -728,12 +822,13 @@ Examples:
         with open(args.symbol_list, "r") as f:
             funs = []
             for line in re.split(r"\r?\n", f.read()):
-                line = re.sub(r"#.*", "", line)
+                line = _RE_COMMENT.sub("", line)
                 line = line.strip()
                 if line:
                     funs.append(line)
 
-    binary = is_binary_file(input_name)
+    dynamic = read_dynamic_section(input_name)
+    binary, is_macho = classify_binary_file(input_name, dynamic)
     stem = os.path.basename(input_name)
     if not binary:
         stem = re.sub(r"\.def$", "", stem)
@@ -741,7 +836,7 @@ Examples:
     if args.library_load_name is not None:
         load_name = args.library_load_name
     elif binary:
-        load_name = read_soname(input_name)
+        load_name = read_soname(input_name, is_macho, dynamic)
         if load_name is None:
             load_name = stem
     else:
@@ -762,29 +857,42 @@ Examples:
     ptr_size = int(cfg["Arch"]["PointerSize"])
     symbol_reloc_types = set(re.split(r"\s*,\s*", cfg["Arch"]["SymbolReloc"]))
 
+    hidden_binds = {"LOCAL", "WEAK"} if args.no_weak_symbols else {"LOCAL"}
+
     def is_exported(s):
-        conditions = [
-            s["Bind"] != "LOCAL",
-            s["Visibility"] != "HIDDEN",
-            s["Type"] != "NOTYPE",
-            s["Ndx"] != "UND",
-            s["Name"] not in ["", "_init", "_fini"],
-        ]
-        if args.no_weak_symbols:
-            conditions.append(s["Bind"] != "WEAK")
-        return all(conditions)
+        return (
+            s["Bind"] not in hidden_binds
+            and s["Visibility"] != "HIDDEN"
+            and s["Type"] != "NOTYPE"
+            and s["Ndx"] != "UND"
+            and s["Name"] not in ("", "_init", "_fini")
+        )
 
     if binary:
-        syms = collect_syms(input_name)
+        syms = collect_syms(input_name, is_macho)
     else:
         syms = collect_def_exports(input_name)
 
     # Also collected demangled names
-    if syms:
-        out, _ = run(["c++filt"], "\n".join((sym["Name"] for sym in syms)))
+    # (they are only needed for vtables and only mangled ones
+    # need to go through c++filt)
+    for sym in syms:
+        sym["Demangled Name"] = sym["Name"]
+    if args.vtables:
+        mangled_syms = [sym for sym in syms if "_Z" in sym["Name"]]
+    else:
+        mangled_syms = []
+    if mangled_syms:
+        out, _ = run(["c++filt"], "\n".join([sym["Name"] for sym in mangled_syms]))
         out = out.rstrip("\n")  # Some c++filts append newlines at the end
-        for i, name in enumerate(out.split("\n")):
-            syms[i]["Demangled Name"] = name
+        demangled_names = out.split("\n")
+        if len(demangled_names) != len(mangled_syms):
+            error(
+                f"c++filt returned {len(demangled_names)} names "
+                f"for {len(mangled_syms)} symbols"
+            )
+        for sym, name in zip(mangled_syms, demangled_names):
+            sym["Demangled Name"] = name
 
     syms = list(filter(is_exported, syms))
 
@@ -850,10 +958,8 @@ Examples:
         cls_syms = {}
 
         for s in syms:
-            m = re.match(
-                r"^(vtable|typeinfo|typeinfo name) for (.*)", s["Demangled Name"]
-            )
-            if m is not None and is_exported(s):
+            m = _RE_VTABLE.match(s["Demangled Name"])
+            if m is not None:  # syms are already filtered by is_exported
                 typ, cls = m.groups()
                 name = s["Name"]
                 cls_tables.setdefault(cls, {})[typ] = name
@@ -864,7 +970,7 @@ Examples:
             for cls, _ in sorted(cls_tables.items()):
                 print(f"  {cls}")
 
-        secs = collect_sections(input_name)
+        secs = collect_sections(input_name, is_macho)
         if verbose:
             print("Sections:")
             for sec in secs:
@@ -875,7 +981,7 @@ Examples:
 
         bites = read_unrelocated_data(input_name, cls_syms, secs)
 
-        rels = collect_relocs(input_name)
+        rels = collect_relocs(input_name, is_macho)
         if verbose:
             print("Relocs:")
             for rel in rels:
@@ -914,19 +1020,20 @@ Examples:
             table_text = string.Template(t.read()).substitute(
                 lib_suffix=lib_suffix, table_size=ptr_size * (len(funs) + 1)
             )
-        f.write(table_text)
 
         with open(target_dir + "/trampoline.S.tpl", "r") as t:
-            tramp_tpl = string.Template(t.read())
+            tramp_tpl = split_template(string.Template(t.read()), lib_suffix=lib_suffix)
 
+        parts = [table_text]
         for i, name in enumerate(funs):
-            tramp_text = tramp_tpl.substitute(
-                lib_suffix=lib_suffix,
+            tramp_text = expand_template(
+                tramp_tpl,
                 sym=args.symbol_prefix + name,
                 offset=i * ptr_size,
                 number=i,
             )
-            f.write(tramp_text)
+            parts.append(tramp_text)
+        f.write("".join(parts))
 
     # Generate C code
 
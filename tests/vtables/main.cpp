@@ -8,6 +8,7 @@
  */
 
 #include <stdio.h>
+#include <typeinfo>
 
 #include "interposed.h"
 
@@ -23,5 +24,8 @@ int main() {
   a->foo(100, 200);
   b->foo(100, 200);
 
+  // Check that RTTI data was copied correctly
+  printf("%s %s\n", typeid(*a).name(), typeid(*b).name());
+
   return 0;
 }